@@ -2,15 +2,32 @@ from flask import Flask, render_template, request, jsonify, send_file, session,
 import requests
 from bs4 import BeautifulSoup
 import pandas as pd
+import numpy as np
 import json
+import gzip
+import base64
+import hashlib
 from datetime import datetime
 from pathlib import Path
 import threading
 import time
+import re
+import sqlite3
+import socket
+import uuid
+import sys
 import os
 import logging
 from dotenv import load_dotenv
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Compressione brotli opzionale: senza il pacchetto si usa solo gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Carica variabili ambiente
 load_dotenv()
@@ -28,6 +45,14 @@ ACCESS_PASSWORD = os.environ.get('ACCESS_PASSWORD', 'serp2026')
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 EXCEL_FILE = DATA_DIR / "serp_monitoring_results.xlsx"
+HISTORY_FILE = DATA_DIR / "serp_history.json"
+SHARD_QUEUE_BACKEND = os.environ.get('SHARD_QUEUE_BACKEND', 'sqlite')
+SHARD_QUEUE_DB = Path(os.environ.get('SHARD_QUEUE_DB', DATA_DIR / "shard_queue.db"))
+
+# Paginazione adattiva: run ricordate per keyword/motore e ogni quante run
+# con profondità ridotta forzare comunque una ricerca completa
+HISTORY_RUNS = 5
+ADAPTIVE_REFRESH_RUNS = int(os.environ.get('ADAPTIVE_REFRESH_RUNS', 5))
 
 # ============================================
 # CONFIGURAZIONE MOTORI DI RICERCA
@@ -47,12 +72,162 @@ SEARCH_ENGINES = {
     }
 }
 
+# ============================================
+# MATRICE LOCALE
+# Ogni locale è una tupla domain/gl/hl/market/cc: le keyword vengono cercate
+# su ogni locale e ogni motore in un unico job concorrente
+# ============================================
+LOCALE_FIELDS = ('domain', 'gl', 'hl', 'market', 'cc')
+
+# Numero di richieste SerpAPI in parallelo e budget condiviso (richieste/secondo)
+MAX_WORKERS = int(os.environ.get('SERP_MAX_WORKERS', 4))
+SERPAPI_MAX_RPS = float(os.environ.get('SERPAPI_MAX_RPS', 4))
+
+class RateLimiter:
+    """Budget di richieste condiviso tra tutti i thread di un job"""
+    
+    def __init__(self, max_per_second):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+    
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+serpapi_limiter = RateLimiter(SERPAPI_MAX_RPS)
+
+# ============================================
+# ESECUZIONE DISTRIBUITA
+# Le keyword di un job vengono divise in shard su una coda (interfaccia ShardQueue);
+# i worker (`python app.py worker`, ognuno col proprio SERPAPI_KEY) li prendono
+# in lease e rinnovano il lease con un heartbeat finché lavorano.
+# Il backend SQLite è solo per un singolo host o per i test: il locking di SQLite
+# non è affidabile su filesystem di rete, per più host serve un backend condiviso
+# ============================================
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', 10))                      # keyword per shard
+SHARD_LEASE_SECONDS = int(os.environ.get('SHARD_LEASE_SECONDS', 120))   # durata lease senza heartbeat
+SHARD_MAX_ATTEMPTS = int(os.environ.get('SHARD_MAX_ATTEMPTS', 3))       # tentativi prima di 'failed'
+SHARD_POLL_SECONDS = float(os.environ.get('SHARD_POLL_SECONDS', 2))
+SHARD_LOCAL_WORKERS = int(os.environ.get('SHARD_LOCAL_WORKERS', 1))     # worker avviati dall'app stessa
+SHARD_JOB_TIMEOUT = int(os.environ.get('SHARD_JOB_TIMEOUT', 3600))      # oltre, gli shard rimasti sono 'failed'
+
+def serpapi_get(params):
+    """Chiamata SerpAPI che rispetta il budget condiviso"""
+    serpapi_limiter.wait()
+    response = requests.get('https://serpapi.com/search', params=params, timeout=15)
+    response.raise_for_status()
+    return response.json()
+
+def is_worker_error(error):
+    """
+    True per gli errori che colpiscono ogni ricerca del worker, non una sola keyword:
+    rete irraggiungibile, chiave non valida o quota SerpAPI esaurita.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in (401, 403, 429)
+    return False
+
+def default_locale():
+    """Locale ricavata dalla configurazione SEARCH_ENGINES"""
+    google_config = SEARCH_ENGINES['google']
+    bing_config = SEARCH_ENGINES['bing']
+    return {
+        'name': google_config['gl'].upper(),
+        'domain': google_config['domain'],
+        'gl': google_config['gl'],
+        'hl': google_config['hl'],
+        'market': bing_config['market'],
+        'cc': bing_config['cc']
+    }
+
+def parse_locale(value):
+    """
+    Normalizza una locale ricevuta da /analyze.
+    Accetta un dict con i campi di LOCALE_FIELDS (più 'name' opzionale)
+    oppure una lista [domain, gl, hl, market, cc] con un sesto elemento 'name' opzionale.
+    Senza nome esplicito 'name' resta None (vedi parse_locales).
+    Solleva ValueError se la locale non è valida.
+    """
+    if isinstance(value, (list, tuple)):
+        if len(value) not in (len(LOCALE_FIELDS), len(LOCALE_FIELDS) + 1):
+            raise ValueError(f"Locale non valida: {value}")
+        value = dict(zip(LOCALE_FIELDS + ('name',), value))
+    if not isinstance(value, dict):
+        raise ValueError(f"Locale non valida: {value}")
+    
+    missing = [f for f in LOCALE_FIELDS if not str(value.get(f) or '').strip()]
+    if missing:
+        raise ValueError(f"Locale non valida, campi mancanti: {', '.join(missing)}")
+    
+    locale = {f: str(value[f]).strip() for f in LOCALE_FIELDS}
+    locale['name'] = str(value.get('name') or '').strip().upper() or None
+    return locale
+
+def parse_locales(values):
+    """
+    Normalizza la matrice di locale e assegna i nomi mancanti: il gl, oppure
+    gl-hl se il gl è condiviso da più mercati (es. en-US e es-US).
+    Solleva ValueError se la matrice non è valida o ci sono nomi duplicati.
+    """
+    locales = [parse_locale(value) for value in values]
+    
+    explicit = {locale['name'] for locale in locales if locale['name']}
+    gl_counts = {}
+    for locale in locales:
+        if not locale['name']:
+            gl_counts[locale['gl'].upper()] = gl_counts.get(locale['gl'].upper(), 0) + 1
+    for locale in locales:
+        if not locale['name']:
+            name = locale['gl'].upper()
+            if gl_counts[name] > 1 or name in explicit:
+                name = f"{locale['gl']}-{locale['hl']}".upper()
+            locale['name'] = name
+    
+    names = [locale['name'] for locale in locales]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Nomi locale duplicati: {', '.join(duplicates)}")
+    return locales
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
 }
 
 analysis_status = {'running': False, 'progress': 0, 'current_keyword': '', 'results': []}
+overlap_results = []  # Confronto Google/Bing dell'ultima analisi (vedi /analytics/overlap)
+result_rows = {'organic': [], 'news': []}  # Righe dell'ultima analisi (vedi /results)
+
+# API risultati: campi selezionabili, dimensione pagina e soglia di compressione
+RESULT_FIELDS = {
+    'organic': ('keyword', 'locale', 'engine', 'position', 'title', 'url', 'snippet', 'date', 'source', 'timestamp', 'carried_over'),
+    'news': ('keyword', 'locale', 'position', 'title', 'url', 'snippet', 'source_name', 'date', 'thumbnail', 'timestamp')
+}
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 500
+COMPRESS_MIN_BYTES = 1024
+RESPONSE_CACHE_SIZE = 256
+
+# Versione dei dati esposti dalle API: cambia a ogni modifica di analysis_status
+# o result_rows e determina ETag e validità della cache delle risposte.
+# BOOT_ID evita che un ETag di un processo precedente risulti ancora valido.
+BOOT_ID = uuid.uuid4().hex[:8]
+data_version = 0
+version_lock = threading.Lock()
+response_cache = {'version': None, 'bodies': {}}
+
+def bump_version():
+    """Da chiamare dopo ogni modifica di analysis_status o result_rows"""
+    global data_version
+    with version_lock:
+        data_version += 1
 
 def login_required(f):
     @wraps(f)
@@ -62,12 +237,82 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def search_google(keyword, num_results=30, time_filter=None, sites=None):
+def json_response(build_payload):
+    """
+    Risposta JSON con ETag e compressione brotli/gzip negoziata su Accept-Encoding.
+    
+    L'ETag dipende solo dalla versione dei dati e dalla richiesta (path + query),
+    quindi un If-None-Match valido ottiene un 304 senza costruire il payload;
+    i corpi già codificati vengono riusati finché la versione non cambia.
+    """
+    version = data_version
+    etag = f"{BOOT_ID}-{version}-{hashlib.sha1(request.full_path.encode('utf-8')).hexdigest()[:16]}"
+    
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        accepted = request.accept_encodings
+        if brotli and accepted['br'] and accepted['br'] >= accepted['gzip']:
+            encoding = 'br'
+        elif accepted['gzip']:
+            encoding = 'gzip'
+        else:
+            encoding = None
+        
+        with version_lock:
+            if response_cache['version'] != version or len(response_cache['bodies']) >= RESPONSE_CACHE_SIZE:
+                response_cache['version'] = version
+                response_cache['bodies'] = {}
+            cached = response_cache['bodies'].get((etag, encoding))
+        
+        if cached is None:
+            body = json.dumps(build_payload(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if len(body) < COMPRESS_MIN_BYTES or encoding is None:
+                cached = (body, None)
+            elif encoding == 'br':
+                cached = (brotli.compress(body), 'br')
+            else:
+                cached = (gzip.compress(body, compresslevel=6), 'gzip')
+            with version_lock:
+                if response_cache['version'] == version:
+                    response_cache['bodies'][(etag, encoding)] = cached
+        
+        body, content_encoding = cached
+        response = app.response_class(body, mimetype='application/json')
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+    
+    # ETag debole: lo stesso contenuto vale per tutte le codifiche
+    response.set_etag(etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+def decode_cursor(cursor):
+    """Offset dal cursore opaco; ValueError se il cursore non è valido"""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))['offset']
+    except Exception:
+        raise ValueError('Cursore non valido')
+    # bool è una sottoclasse di int: {"offset": true} non è un cursore valido
+    if type(offset) is not int or offset < 0:
+        raise ValueError('Cursore non valido')
+    return offset
+
+def search_google(keyword, num_results=30, time_filter=None, sites=None, locale=None, start_page=0, stats=None):
     """
     Cerca su Google con paginazione per ottenere più di 10 risultati.
-    Configurabile tramite SEARCH_ENGINES['google']
+    Configurabile tramite SEARCH_ENGINES['google'] o con una locale della matrice
     
     🔧 FIX: Non si ferma più alla prima pagina vuota
+    
+    start_page permette di saltare le prime pagine (num_results resta il target
+    complessivo); stats['pages'] conta le richieste SerpAPI effettuate e
+    stats['error'] viene valorizzato se la ricerca fallisce (stats['worker_error']
+    se l'errore riguarda tutte le ricerche del worker, vedi is_worker_error).
     """
     if not SEARCH_ENGINES['google']['enabled']:
         return []
@@ -75,6 +320,9 @@ def search_google(keyword, num_results=30, time_filter=None, sites=None):
     serpapi_key = os.getenv('SERPAPI_KEY')
     if not serpapi_key:
         logging.error("SERPAPI_KEY non configurata!")
+        if stats is not None:
+            stats['error'] = 'SERPAPI_KEY non configurata'
+            stats['worker_error'] = True
         return []
     
     # Costruisci query con filtro siti se specificato
@@ -89,10 +337,10 @@ def search_google(keyword, num_results=30, time_filter=None, sites=None):
     empty_pages = 0  # 🔧 Conta pagine vuote consecutive
     
     try:
-        google_config = SEARCH_ENGINES['google']
+        google_config = locale or default_locale()
         logging.info(f"🔍 Google.{google_config['gl']}: {keyword} (target {num_results} risultati, {pages_needed} pagine)")
         
-        for page in range(pages_needed):
+        for page in range(start_page, pages_needed):
             start = page * 10
             
             params = {
@@ -110,9 +358,9 @@ def search_google(keyword, num_results=30, time_filter=None, sites=None):
             elif time_filter == 'week': params['tbs'] = 'qdr:w'
             elif time_filter == 'month': params['tbs'] = 'qdr:m'
             
-            response = requests.get('https://serpapi.com/search', params=params, timeout=15)
-            response.raise_for_status()
-            data = response.json()
+            data = serpapi_get(params)
+            if stats is not None:
+                stats['pages'] = stats.get('pages', 0) + 1
             
             organic_results = data.get('organic_results', [])
             
@@ -145,13 +393,15 @@ def search_google(keyword, num_results=30, time_filter=None, sites=None):
                     'url': item.get('link', 'N/A'),
                     'snippet': item.get('snippet', ''),
                     'date': pub_date if pub_date else 'N/A',
-                    'source': f"Google.{google_config['gl']}"
+                    'source': f"Google.{google_config['gl']}",
+                    'engine': 'google',
+                    'locale': google_config['name']
                 })
             
             logging.info(f"  Pagina {page+1}: +{len(organic_results)} risultati (totale: {len(all_results)})")
             
             # 🔧 Fermati se abbiamo raggiunto il numero richiesto
-            if len(all_results) >= num_results:
+            if len(all_results) >= num_results - start_page * 10:
                 logging.info(f"  ✓ Raggiunto target di {num_results} risultati")
                 break
             
@@ -159,26 +409,38 @@ def search_google(keyword, num_results=30, time_filter=None, sites=None):
                 time.sleep(0.5)
         
         logging.info(f"✓ Totale {len(all_results)} risultati Google")
-        return all_results[:num_results]
+        return all_results[:num_results - start_page * 10]
         
     except Exception as e:
         logging.error(f"✗ Errore Google: {e}")
+        # Segnala l'errore al chiamante: i risultati parziali non sono affidabili
+        if stats is not None:
+            stats['error'] = str(e)
+            stats['worker_error'] = is_worker_error(e)
         import traceback
         logging.error(traceback.format_exc())
         return all_results
 
-def search_bing(keyword, num_results=30, time_filter=None, sites=None):
+def search_bing(keyword, num_results=30, time_filter=None, sites=None, locale=None, start_page=0, stats=None):
     """
     Cerca su Bing con paginazione.
-    Configurabile tramite SEARCH_ENGINES['bing']
+    Configurabile tramite SEARCH_ENGINES['bing'] o con una locale della matrice
     
     🔧 FIX: Non si ferma più alla prima pagina vuota
+    
+    start_page permette di saltare le prime pagine (num_results resta il target
+    complessivo); stats['pages'] conta le richieste SerpAPI effettuate e
+    stats['error'] viene valorizzato se la ricerca fallisce (stats['worker_error']
+    se l'errore riguarda tutte le ricerche del worker, vedi is_worker_error).
     """
     if not SEARCH_ENGINES['bing']['enabled']:
         return []
         
     serpapi_key = os.getenv('SERPAPI_KEY')
     if not serpapi_key:
+        if stats is not None:
+            stats['error'] = 'SERPAPI_KEY non configurata'
+            stats['worker_error'] = True
         return []
     
     # Costruisci query con filtro siti se specificato
@@ -193,10 +455,10 @@ def search_bing(keyword, num_results=30, time_filter=None, sites=None):
     empty_pages = 0  # 🔧 Conta pagine vuote consecutive
     
     try:
-        bing_config = SEARCH_ENGINES['bing']
+        bing_config = locale or default_locale()
         logging.info(f"🔍 Bing.{bing_config['cc']}: {keyword} (target {num_results} risultati, {pages_needed} pagine)")
         
-        for page in range(pages_needed):
+        for page in range(start_page, pages_needed):
             offset = page * 10
             
             params = {
@@ -209,9 +471,9 @@ def search_bing(keyword, num_results=30, time_filter=None, sites=None):
                 'api_key': serpapi_key
             }
             
-            response = requests.get('https://serpapi.com/search', params=params, timeout=15)
-            response.raise_for_status()
-            data = response.json()
+            data = serpapi_get(params)
+            if stats is not None:
+                stats['pages'] = stats.get('pages', 0) + 1
             
             organic_results = data.get('organic_results', [])
             
@@ -244,13 +506,15 @@ def search_bing(keyword, num_results=30, time_filter=None, sites=None):
                     'url': item.get('link', 'N/A'),
                     'snippet': item.get('snippet', ''),
                     'date': pub_date if pub_date else 'N/A',
-                    'source': f"Bing.{bing_config['cc']}"
+                    'source': f"Bing.{bing_config['cc']}",
+                    'engine': 'bing',
+                    'locale': bing_config['name']
                 })
             
             logging.info(f"  Pagina {page+1}: +{len(organic_results)} risultati (totale: {len(all_results)})")
             
             # 🔧 Fermati se abbiamo raggiunto il numero richiesto
-            if len(all_results) >= num_results:
+            if len(all_results) >= num_results - start_page * 10:
                 logging.info(f"  ✓ Raggiunto target di {num_results} risultati")
                 break
             
@@ -258,15 +522,130 @@ def search_bing(keyword, num_results=30, time_filter=None, sites=None):
                 time.sleep(0.5)
         
         logging.info(f"✓ Totale {len(all_results)} risultati Bing")
-        return all_results[:num_results]
+        return all_results[:num_results - start_page * 10]
         
     except Exception as e:
         logging.error(f"✗ Errore Bing: {e}")
+        # Segnala l'errore al chiamante: i risultati parziali non sono affidabili
+        if stats is not None:
+            stats['error'] = str(e)
+            stats['worker_error'] = is_worker_error(e)
         import traceback
         logging.error(traceback.format_exc())
         return all_results
 
-def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
+def history_key(engine, keyword, locale, time_filter=None, sites=None):
+    """Chiave dello storico: stesse keyword/motore/locale/filtri"""
+    site_key = ','.join(sorted(site.strip() for site in sites or []))
+    return f"{engine}|{locale['name']}|{time_filter or ''}|{site_key}|{keyword}"
+
+def load_history():
+    """Carica lo storico delle run precedenti (vuoto se assente o illeggibile)"""
+    if not HISTORY_FILE.exists():
+        return {}
+    try:
+        return json.loads(HISTORY_FILE.read_text(encoding='utf-8'))
+    except Exception as e:
+        logging.error(f"✗ Errore lettura storico: {e}")
+        return {}
+
+def save_history(history):
+    """Salva lo storico delle run nella cartella data"""
+    try:
+        HISTORY_FILE.write_text(json.dumps(history, ensure_ascii=False), encoding='utf-8')
+    except Exception as e:
+        logging.error(f"✗ Errore salvataggio storico: {e}")
+
+def top_urls(results, top_n=10):
+    """URL canonici della top N, nell'ordine di posizione"""
+    urls = pd.Series([r['url'] for r in results[:top_n]], dtype=object)
+    return canonical_urls(urls).tolist()
+
+def update_history(history, key, results, num_results, full=True):
+    """Registra nello storico l'esito di una ricerca organica"""
+    entry = history.setdefault(key, {'runs': [], 'partial_runs': 0, 'results': []})
+    carried = any(r.get('carried_over') for r in results)
+    if carried and entry['runs']:
+        exhausted = entry['runs'][-1]['exhausted']
+    else:
+        exhausted = len(results) < num_results
+    
+    entry['runs'] = (entry['runs'] + [{
+        'timestamp': datetime.now().isoformat(),
+        'num_results': num_results,
+        'results': len(results),
+        'exhausted': exhausted,
+        'top': top_urls(results)
+    }])[-HISTORY_RUNS:]
+    entry['partial_runs'] = 0 if full else entry['partial_runs'] + 1
+    entry['results'] = [{k: r[k] for k in ('position', 'title', 'url', 'snippet', 'date')} for r in results]
+
+def adaptive_search(keyword, engine, num_results=30, time_filter=None, sites=None, locale=None, history=None, stats=None):
+    """
+    Ricerca organica con profondità decisa dalle run precedenti della stessa keyword/motore.
+    
+    - Se le ultime run non hanno mai avuto risultati oltre pagina N, si scaricano al massimo N pagine
+    - Si scarica prima la sola pagina 1: se la top 10 non è cambiata rispetto all'ultima run,
+      le posizioni successive vengono riprese dallo storico (campo 'carried_over')
+    - Ogni ADAPTIVE_REFRESH_RUNS run ridotte si forza comunque una ricerca completa
+    
+    In stats vengono registrate le pagine richieste ('pages'), quelle che avrebbe
+    richiesto la ricerca classica ('baseline') e se la ricerca è stata completa ('full').
+    """
+    search_fn = search_google if engine == 'google' else search_bing
+    locale = locale or default_locale()
+    stats = stats if stats is not None else {}
+    kwargs = {'time_filter': time_filter, 'sites': sites, 'locale': locale, 'stats': stats}
+    
+    requested_pages = (num_results + 9) // 10
+    stats['full'] = True
+    
+    entry = (history or {}).get(history_key(engine, keyword, locale, time_filter, sites))
+    if not entry or not entry['runs'] or entry['partial_runs'] >= ADAPTIVE_REFRESH_RUNS or requested_pages <= 1:
+        # Ricerca classica: nessun risparmio rispetto alla baseline
+        results = search_fn(keyword, num_results=num_results, **kwargs)
+        stats['baseline'] = stats.get('pages', 0)
+        return results
+    
+    stats['baseline'] = requested_pages
+    
+    runs = entry['runs']
+    depth = requested_pages
+    if all(run['exhausted'] for run in runs):
+        # Le ultime run si sono sempre fermate prima: inutile chiedere pagine vuote
+        filled_pages = max(1, (max(run['results'] for run in runs) + 9) // 10)
+        depth = min(requested_pages, filled_pages)
+        # La ricerca classica paga anche le 2 pagine vuote prima di fermarsi
+        stats['baseline'] = min(requested_pages, filled_pages + 2)
+    
+    shallow = search_fn(keyword, num_results=10, **kwargs)
+    stats['full'] = depth == requested_pages
+    if depth <= 1:
+        return shallow
+    
+    # Lo storico copre le posizioni richieste se l'ultima run era profonda almeno
+    # quanto questa o se si era già fermata per mancanza di risultati
+    last = runs[-1]
+    covered = last.get('num_results', 0) >= num_results or last['exhausted']
+    if covered and top_urls(shallow) == last['top']:
+        logging.info(f"  ⚡ {engine} '{keyword}' ({locale['name']}): top 10 invariata, posizioni successive dallo storico")
+        stats['full'] = False
+        source = f"Google.{locale['gl']}" if engine == 'google' else f"Bing.{locale['cc']}"
+        carried = [dict(r, source=source, engine=engine, locale=locale['name'], carried_over=True)
+                   for r in entry['results'] if 10 < r['position'] <= num_results]
+        return shallow + carried
+    
+    deeper = search_fn(keyword, num_results=min(depth * 10, num_results), start_page=1, **kwargs)
+    return shallow + deeper
+
+def organic_search_task(keyword, engine, locale, num_results=30, time_filter=None, sites=None, history=None, stats=None):
+    """Funzione e parametri di una ricerca organica (adattiva se c'è uno storico)"""
+    kwargs = {'num_results': num_results, 'time_filter': time_filter, 'sites': sites, 'locale': locale, 'stats': stats}
+    if history is not None:
+        return adaptive_search, dict(kwargs, engine=engine, history=history)
+    return (search_google if engine == 'google' else search_bing), kwargs
+
+def search_google_news(keyword, num_results=10, time_filter=None, sites=None, locale=None):
     """
     Cerca nelle Google News (Notizie principali) con paginazione.
     Restituisce le notizie più recenti per la keyword.
@@ -276,6 +655,7 @@ def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
         num_results: Numero totale di notizie desiderate
         time_filter: Filtro temporale (day, week, month)
         sites: Lista di domini per limitare la ricerca
+        locale: Locale della matrice (default: SEARCH_ENGINES)
     """
     if not SEARCH_ENGINES['google']['enabled']:
         return []
@@ -296,7 +676,7 @@ def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
     pages_needed = (num_results + 9) // 10  # Google News restituisce ~10 risultati per pagina
     
     try:
-        google_config = SEARCH_ENGINES['google']
+        google_config = locale or default_locale()
         logging.info(f"📰 Google News ({google_config['gl']}): {keyword} (target {num_results} notizie, {pages_needed} pagine)")
         
         for page in range(pages_needed):
@@ -325,9 +705,7 @@ def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
                 params['tbs'] = 'qdr:m'
                 logging.info(f"   Filtro temporale: ultimo mese")
             
-            response = requests.get('https://serpapi.com/search', params=params, timeout=15)
-            response.raise_for_status()
-            data = response.json()
+            data = serpapi_get(params)
             
             news_results = data.get('news_results', [])
             
@@ -349,7 +727,8 @@ def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
                     'source_name': source_name,
                     'date': date,
                     'thumbnail': item.get('thumbnail', ''),
-                    'type': 'Google News'
+                    'type': 'Google News',
+                    'locale': google_config['name']
                 })
             
             logging.info(f"  Pagina {page+1}: +{len(news_results)} notizie")
@@ -367,7 +746,7 @@ def search_google_news(keyword, num_results=10, time_filter=None, sites=None):
         logging.error(traceback.format_exc())
         return []
 
-def search_google_images(keyword, num_results=30, sites=None):
+def search_google_images(keyword, num_results=30, sites=None, locale=None):
     """Cerca immagini su Google"""
     if not SEARCH_ENGINES['google']['enabled']:
         return []
@@ -382,7 +761,7 @@ def search_google_images(keyword, num_results=30, sites=None):
         query = f'{keyword} ({site_filter})'
     
     try:
-        google_config = SEARCH_ENGINES['google']
+        google_config = locale or default_locale()
         logging.info(f"🖼️  Google Images ({google_config['gl']}): {keyword}")
         
         params = {
@@ -395,9 +774,7 @@ def search_google_images(keyword, num_results=30, sites=None):
             'api_key': serpapi_key
         }
         
-        response = requests.get('https://serpapi.com/search', params=params, timeout=15)
-        response.raise_for_status()
-        data = response.json()
+        data = serpapi_get(params)
         
         images = []
         for idx, item in enumerate(data.get('images_results', [])[:num_results], 1):
@@ -417,9 +794,490 @@ def search_google_images(keyword, num_results=30, sites=None):
         logging.error(f"✗ Errore Google Images: {e}")
         return []
 
-def save_results(results, summary, images=None, news=None):
+class ShardQueueError(Exception):
+    """Errore del backend della coda (i worker lo registrano e riprovano)"""
+
+class ShardQueue:
+    """
+    Interfaccia della coda di shard con lease, usata da run_worker e distribute_job.
+    
+    Uno shard in lease il cui lease è scaduto (worker morto o bloccato) deve
+    tornare disponibile al prossimo claim; dopo SHARD_MAX_ATTEMPTS tentativi
+    va marcato 'failed'. Gli errori del backend vanno sollevati come ShardQueueError.
+    Per eseguire worker su più host serve un backend condiviso (es. Redis o
+    Postgres) che implementi questi metodi e venga registrato in get_shard_queue.
+    """
+    
+    def enqueue(self, job_id, payloads):
+        """Mette in coda i payload del job, uno shard per payload"""
+        raise NotImplementedError
+    
+    def claim(self, worker_id, lease_seconds=SHARD_LEASE_SECONDS):
+        """Prende in lease il primo shard disponibile: {'id', 'job_id', 'payload', 'attempt'} o None"""
+        raise NotImplementedError
+    
+    def heartbeat(self, shard_id, worker_id, lease_seconds=SHARD_LEASE_SECONDS):
+        """Rinnova il lease; False se il lease è passato a un altro worker"""
+        raise NotImplementedError
+    
+    def complete(self, shard_id, worker_id, result):
+        """Registra il risultato dello shard"""
+        raise NotImplementedError
+    
+    def fail(self, shard_id, worker_id, error):
+        """Rimette lo shard in coda, o lo marca 'failed' se ha finito i tentativi"""
+        raise NotImplementedError
+    
+    def progress(self, job_id):
+        """Numero di shard del job per stato"""
+        raise NotImplementedError
+    
+    def results(self, job_id):
+        """Risultati degli shard completati del job"""
+        raise NotImplementedError
+    
+    def errors(self, job_id):
+        """Coppie (shard_id, errore) degli shard falliti del job"""
+        raise NotImplementedError
+    
+    def abandon(self, job_id, error):
+        """Marca 'failed' gli shard del job non ancora completati"""
+        raise NotImplementedError
+    
+    def delete_job(self, job_id):
+        """Elimina gli shard del job"""
+        raise NotImplementedError
+
+class SQLiteShardQueue(ShardQueue):
+    """
+    Coda di shard su SQLite: worker e coordinatore devono girare sullo stesso
+    host (o nei test). Non condividere il file tra host su un volume di rete,
+    il locking di SQLite (BEGIN IMMEDIATE) non è affidabile su NFS/SMB.
+    """
+    
+    def __init__(self, path=SHARD_QUEUE_DB):
+        self.path = Path(path)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shards (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_shards_job ON shards (job_id, status)")
+    
+    @contextmanager
+    def _connect(self):
+        # Autocommit: ogni statement è una transazione, claim usa BEGIN IMMEDIATE
+        try:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        except sqlite3.Error as e:
+            raise ShardQueueError(str(e)) from e
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            raise ShardQueueError(str(e)) from e
+        finally:
+            conn.close()
+    
+    def __str__(self):
+        return f"sqlite:{self.path}"
+    
+    def _expire(self, conn, now):
+        # Lease scaduti che hanno esaurito i tentativi
+        conn.execute(
+            "UPDATE shards SET status = 'failed', error = 'lease scaduto' "
+            "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, SHARD_MAX_ATTEMPTS))
+    
+    def enqueue(self, job_id, payloads):
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO shards (job_id, payload) VALUES (?, ?)",
+                             [(job_id, json.dumps(p)) for p in payloads])
+    
+    def claim(self, worker_id, lease_seconds=SHARD_LEASE_SECONDS):
+        """Prende in lease il primo shard disponibile; None se la coda è vuota"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self._expire(conn, now)
+                row = conn.execute(
+                    "SELECT id, job_id, payload, attempts FROM shards "
+                    "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                    "ORDER BY id LIMIT 1", (now,)).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        (worker_id, now + lease_seconds, row['id']))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        
+        if not row:
+            return None
+        return {'id': row['id'], 'job_id': row['job_id'], 'payload': json.loads(row['payload']), 'attempt': row['attempts'] + 1}
+    
+    def heartbeat(self, shard_id, worker_id, lease_seconds=SHARD_LEASE_SECONDS):
+        """Rinnova il lease; False se il lease è passato a un altro worker"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE shards SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + lease_seconds, shard_id, worker_id))
+            return cursor.rowcount > 0
+    
+    def complete(self, shard_id, worker_id, result):
+        # Le ricerche sono idempotenti: si accetta il primo risultato che arriva
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE shards SET status = 'done', worker = ?, result = ?, error = NULL WHERE id = ? AND status != 'done'",
+                (worker_id, json.dumps(result), shard_id))
+    
+    def fail(self, shard_id, worker_id, error):
+        """Rimette lo shard in coda, o lo marca 'failed' se ha finito i tentativi"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_until = NULL, error = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (SHARD_MAX_ATTEMPTS, str(error), shard_id, worker_id))
+    
+    def progress(self, job_id):
+        """Numero di shard del job per stato"""
+        with self._connect() as conn:
+            self._expire(conn, time.time())
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM shards WHERE job_id = ? GROUP BY status", (job_id,))
+            return {row['status']: row['n'] for row in rows}
+    
+    def results(self, job_id):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT result FROM shards WHERE job_id = ? AND status = 'done' ORDER BY id", (job_id,))
+            return [json.loads(row['result']) for row in rows]
+    
+    def errors(self, job_id):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, error FROM shards WHERE job_id = ? AND status = 'failed'", (job_id,))
+            return [(row['id'], row['error']) for row in rows]
+    
+    def abandon(self, job_id, error):
+        """Marca 'failed' gli shard del job non ancora completati"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE shards SET status = 'failed', error = ? WHERE job_id = ? AND status IN ('pending', 'leased')",
+                (error, job_id))
+    
+    def delete_job(self, job_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM shards WHERE job_id = ?", (job_id,))
+
+def get_shard_queue():
+    """Coda di shard configurata con SHARD_QUEUE_BACKEND"""
+    if SHARD_QUEUE_BACKEND == 'sqlite':
+        return SQLiteShardQueue()
+    raise ValueError(f"Backend coda non supportato: {SHARD_QUEUE_BACKEND}")
+
+def run_shard(payload):
+    """
+    Esegue le ricerche organiche di uno shard e restituisce le righe trovate.
+    
+    Una ricerca fallita per un motivo suo (es. richiesta rifiutata) resta nella
+    propria riga con stats['error'], senza rifare le altre ricerche già pagate.
+    Se invece l'errore riguarda il worker (chiave non valida, quota esaurita,
+    errore di rete) solleva RuntimeError, così lo shard torna in coda.
+    """
+    history = payload.get('history')
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for keyword in payload['keywords']:
+            for locale in payload['locales']:
+                for engine in ('google', 'bing'):
+                    stats = {}
+                    search_fn, kwargs = organic_search_task(
+                        keyword, engine, locale, payload['num_results'], payload['time_filter'],
+                        payload['sites'], history, stats)
+                    futures[executor.submit(search_fn, keyword, **kwargs)] = (keyword, locale['name'], engine, stats)
+    
+    rows = []
+    for future, (keyword, locale_name, engine, stats) in futures.items():
+        results = future.result()
+        if stats.get('worker_error'):
+            raise RuntimeError(f"{engine} '{keyword}' ({locale_name}): {stats['error']}")
+        rows.append({'keyword': keyword, 'locale': locale_name, 'engine': engine,
+                     'results': results, 'stats': stats})
+    return {'rows': rows}
+
+def run_worker(queue=None, worker_id=None, stop_event=None):
+    """
+    Loop di un worker: prende shard in lease, li esegue con le funzioni di ricerca
+    e ne pubblica i risultati. Un thread di heartbeat rinnova il lease finché lo shard è in corso.
+    """
+    queue = queue or get_shard_queue()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+    stop_event = stop_event or threading.Event()
+    logging.info(f"👷 Worker {worker_id} avviato (coda: {queue})")
+    
+    while not stop_event.is_set():
+        try:
+            shard = queue.claim(worker_id)
+        except ShardQueueError as e:
+            logging.error(f"✗ Errore coda: {e}")
+            stop_event.wait(SHARD_POLL_SECONDS)
+            continue
+        if not shard:
+            stop_event.wait(SHARD_POLL_SECONDS)
+            continue
+        
+        logging.info(f"👷 {worker_id}: shard {shard['id']} del job {shard['job_id']} (tentativo {shard['attempt']})")
+        shard_done = threading.Event()
+        
+        def heartbeat():
+            while not shard_done.wait(SHARD_LEASE_SECONDS / 3):
+                try:
+                    if not queue.heartbeat(shard['id'], worker_id):
+                        logging.warning(f"  Lease dello shard {shard['id']} perso")
+                        return
+                except ShardQueueError as e:
+                    logging.error(f"✗ Errore heartbeat shard {shard['id']}: {e}")
+        
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            try:
+                result = run_shard(shard['payload'])
+            except Exception as e:
+                logging.error(f"✗ Errore shard {shard['id']}: {e}")
+                queue.fail(shard['id'], worker_id, e)
+            else:
+                queue.complete(shard['id'], worker_id, result)
+                logging.info(f"  ✓ Shard {shard['id']} completato")
+        except ShardQueueError as e:
+            # Lo shard resta in lease: alla scadenza tornerà disponibile
+            logging.error(f"✗ Errore coda sullo shard {shard['id']}: {e}")
+        finally:
+            shard_done.set()
+            beat.join()
+
+def distribute_job(keywords, locales, page_stats, num_results=30, time_filter=None, sites=None, history=None):
+    """
+    Coordinatore: divide le keyword in shard, li mette in coda e attende che
+    i worker (locali e remoti) li completino. Restituisce i risultati organici
+    uniti, con la stessa chiave (keyword, locale, motore) della ricerca locale.
+    """
+    queue = get_shard_queue()
+    job_id = uuid.uuid4().hex
+    
+    payloads = []
+    for i in range(0, len(keywords), SHARD_SIZE):
+        shard_keywords = keywords[i:i + SHARD_SIZE]
+        payload = {'keywords': shard_keywords, 'locales': locales, 'num_results': num_results,
+                   'time_filter': time_filter, 'sites': sites, 'history': None}
+        if history is not None:
+            # Ogni shard porta con sé lo storico delle proprie keyword per la paginazione adattiva
+            payload['history'] = {}
+            for keyword in shard_keywords:
+                for locale in locales:
+                    for engine in ('google', 'bing'):
+                        key = history_key(engine, keyword, locale, time_filter, sites)
+                        if key in history:
+                            payload['history'][key] = history[key]
+        payloads.append(payload)
+    queue.enqueue(job_id, payloads)
+    logging.info(f"📦 Job {job_id}: {len(payloads)} shard da {SHARD_SIZE} keyword in coda")
+    
+    stop_event = threading.Event()
+    local_workers = [threading.Thread(target=run_worker, args=(queue, f"{socket.gethostname()}-locale-{n}", stop_event), daemon=True)
+                     for n in range(SHARD_LOCAL_WORKERS)]
+    for worker in local_workers:
+        worker.start()
+    if not local_workers:
+        logging.warning(f"  Nessun worker locale: servono worker remoti entro {SHARD_JOB_TIMEOUT}s")
+    
+    deadline = time.monotonic() + SHARD_JOB_TIMEOUT
+    try:
+        while True:
+            try:
+                progress = queue.progress(job_id)
+            except ShardQueueError as e:
+                logging.error(f"✗ Errore coda: {e}")
+                progress = {}
+            finished = progress.get('done', 0) + progress.get('failed', 0)
+            analysis_status['current_keyword'] = f"Shard completati: {finished}/{len(payloads)}"
+            analysis_status['progress'] = int((finished / len(payloads)) * 100)
+            bump_version()
+            if finished >= len(payloads):
+                break
+            if time.monotonic() > deadline:
+                logging.error(f"✗ Job {job_id}: timeout dopo {SHARD_JOB_TIMEOUT}s, shard rimasti marcati come falliti")
+                queue.abandon(job_id, 'timeout job')
+                break
+            time.sleep(SHARD_POLL_SECONDS)
+    finally:
+        stop_event.set()
+        for worker in local_workers:
+            worker.join()
+    
+    failed_shards = queue.errors(job_id)
+    for shard_id, error in failed_shards:
+        logging.error(f"✗ Shard {shard_id} fallito: {error}")
+    analysis_status['failed_shards'] = len(failed_shards)
+    
+    found = {}
+    for result in queue.results(job_id):
+        for row in result['rows']:
+            key = (row['keyword'], row['locale'], row['engine'])
+            found[key] = row['results']
+            page_stats[key].update(row['stats'])
+    queue.delete_job(job_id)
+    
+    # Le ricerche degli shard falliti restano vuote nel report (e fuori dallo storico)
+    for key in page_stats:
+        if key not in found:
+            found[key] = []
+            page_stats[key]['error'] = 'shard fallito'
+    return found
+
+def canonical_urls(urls):
+    """
+    Normalizza una Series di URL per il confronto tra motori:
+    ignora schema, www, maiuscole nel dominio, frammenti, parametri utm_ e slash finale.
+    """
+    parts = urls.str.extract(r'^(?:[a-z][a-z0-9+.-]*://)?(?:www\.)?([^/?#]*)([^?#]*)(?:\?([^#]*))?',
+                             flags=re.IGNORECASE)
+    host = parts[0].str.lower()
+    # lo slash finale va tolto dal path, prima della query: /a/?b=2 e /a?b=2 sono lo stesso URL
+    path = parts[1].str.rstrip('/')
+    query = (parts[2].fillna('')
+             .str.replace(r'(?:^|&)utm_[^&]*', '', regex=True)
+             .str.strip('&'))
+    return host + path + ('?' + query).where(query != '', '')
+
+def _lists_by_group(frame, group, order):
+    """URL canonici raccolti in una lista per gruppo, ordinati per posizione"""
+    if frame.empty:
+        return pd.Series(dtype=object)
+    frame = frame.sort_values(group + [order])
+    starts = np.flatnonzero(frame[group].ne(frame[group].shift()).any(axis=1))
+    chunks = np.split(frame['canonical'].to_numpy(), starts[1:])
+    index = pd.MultiIndex.from_frame(frame[group].iloc[starts])
+    return pd.Series([list(chunk) for chunk in chunks], index=index)
+
+def compute_engine_overlap(results, top_n=10):
+    """
+    Confronto Google/Bing per keyword e locale calcolato in blocco su tutti i risultati:
+    - jaccard: sovrapposizione degli URL canonici
+    - spearman / kendall: correlazione di rango sugli URL presenti in entrambi i motori
+    - google_only_top10 / bing_only_top10: URL nella top 10 di un solo motore
+    
+    Restituisce un DataFrame con una riga per coppia keyword/locale.
+    """
+    group = ['keyword', 'locale']
+    columns = group + ['google_results', 'bing_results', 'shared_urls', 'jaccard',
+                       'spearman', 'kendall', 'google_only_top10', 'bing_only_top10']
+    
+    df = pd.DataFrame(results, columns=group + ['engine', 'position', 'url'])
+    df = df[df['url'].notna() & (df['url'] != 'N/A') & df['engine'].isin(['google', 'bing'])]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    
+    # Normalizza una sola volta ogni URL distinto
+    codes, uniques = pd.factorize(df['url'])
+    df['canonical'] = canonical_urls(pd.Series(uniques, dtype=object)).to_numpy()[codes]
+    
+    # Una riga per URL canonico, con la miglior posizione su ogni motore
+    wide = (df.pivot_table(index=group + ['canonical'], columns='engine', values='position', aggfunc='min')
+              .reindex(columns=['google', 'bing']))
+    in_google = wide['google'].notna()
+    in_bing = wide['bing'].notna()
+    shared = in_google & in_bing
+    
+    counts = pd.DataFrame({
+        'google_results': in_google,
+        'bing_results': in_bing,
+        'shared_urls': shared,
+        'union': in_google | in_bing
+    }).groupby(level=group).sum()
+    counts['jaccard'] = counts['shared_urls'] / counts['union']
+    
+    # Spearman: ranghi ricalcolati tra i soli URL condivisi (posizioni distinte, niente pareggi)
+    common = wide[shared]
+    ranks = common.groupby(level=group).rank()
+    n = counts['shared_urls']
+    d2 = ((ranks['google'] - ranks['bing']) ** 2).groupby(level=group).sum().reindex(counts.index, fill_value=0)
+    counts['spearman'] = (1 - 6 * d2 / (n * (n ** 2 - 1))).where(n >= 2)
+    
+    # Kendall tau: coppie di URL condivisi concordanti meno discordanti
+    flat = common.reset_index()
+    pairs = flat.merge(flat, on=group)
+    pairs = pairs[pairs['canonical_x'] < pairs['canonical_y']]
+    concordance = np.sign((pairs['google_x'] - pairs['google_y']) * (pairs['bing_x'] - pairs['bing_y']))
+    tau = concordance.groupby([pairs['keyword'], pairs['locale']]).mean()
+    counts['kendall'] = tau.reindex(counts.index)
+    
+    # URL presenti nella top N di un solo motore
+    top = wide.reset_index()
+    google_top = top['google'] <= top_n
+    bing_top = top['bing'] <= top_n
+    counts['google_only_top10'] = _lists_by_group(top[google_top & ~bing_top], group, 'google')
+    counts['bing_only_top10'] = _lists_by_group(top[bing_top & ~google_top], group, 'bing')
+    for col in ['google_only_top10', 'bing_only_top10']:
+        counts[col] = counts[col].apply(lambda v: v if isinstance(v, list) else [])
+    
+    return counts.reset_index()[columns]
+
+def overlap_records(overlap):
+    """Righe del confronto motori serializzabili in JSON (NaN -> None)"""
+    rounded = overlap.round({'jaccard': 3, 'spearman': 3, 'kendall': 3})
+    return rounded.astype(object).where(rounded.notna(), None).to_dict('records')
+
+def excel_sheet_name(name, used=None):
+    """
+    Nome foglio valido per Excel (max 31 caratteri, senza caratteri riservati).
+    Con used (nomi già assegnati, in minuscolo) il nome viene reso univoco con un
+    suffisso " (2)", " (3)"...: Excel non distingue maiuscole e minuscole e
+    pandas scriverebbe due fogli omonimi nello stesso foglio.
+    """
+    base = re.sub(r'[\[\]:*?/\\]', '', name)
+    sheet_name = base[:31]
+    if used is None:
+        return sheet_name
+    counter = 2
+    while sheet_name.lower() in used:
+        suffix = f" ({counter})"
+        sheet_name = base[:31 - len(suffix)] + suffix
+        counter += 1
+    used.add(sheet_name.lower())
+    return sheet_name
+
+def compare_locales(df_results):
+    """
+    Confronto posizioni tra locale calcolato in un'unica pivot:
+    una riga per keyword/motore/URL e una colonna di posizione per locale.
+    """
+    pivot = df_results.pivot_table(index=['keyword', 'engine', 'url'], columns='locale',
+                                   values='position', aggfunc='min')
+    locale_columns = list(pivot.columns)
+    pivot.columns = [f"Posizione {c}" for c in locale_columns]
+    positions = pivot[pivot.columns]
+    
+    pivot['Locale presenti'] = positions.notna().sum(axis=1)
+    pivot['Miglior posizione'] = positions.min(axis=1)
+    pivot['Delta posizioni'] = positions.max(axis=1) - positions.min(axis=1)
+    
+    return pivot.reset_index().sort_values(['keyword', 'engine', 'Miglior posizione'])
+
+def save_results(results, summary, images=None, news=None, overlap=None):
     """
-    Salva risultati in Excel con fogli separati per Google, Bing e News
+    Salva risultati in Excel con fogli separati per Google, Bing e News.
+    Con più locale scrive un foglio per locale e il foglio "Confronto Locale";
+    se presente, il confronto Google/Bing va nel foglio "Confronto Motori".
     
     🔧 FIX: Corretto il salvataggio del foglio Google News
     """
@@ -431,19 +1289,57 @@ def save_results(results, summary, images=None, news=None):
             if results:
                 df_all = pd.DataFrame(results)
                 
-                # Foglio Google (solo risultati organici)
-                google_results = df_all[df_all['source'].str.contains('Google', na=False)]
-                if not google_results.empty:
-                    google_results = google_results[['keyword', 'position', 'title', 'url', 'snippet', 'date', 'timestamp']]
-                    google_results.to_excel(writer, sheet_name='Google', index=False)
-                    logging.info(f"  ✓ Foglio Google: {len(google_results)} risultati")
+                result_columns = ['keyword', 'position', 'title', 'url', 'snippet', 'date', 'timestamp', 'carried_over']
+                # Righe riprese dallo storico dalla paginazione adattiva
+                if 'carried_over' in df_all:
+                    df_all['carried_over'] = df_all['carried_over'].fillna(False).astype(bool)
+                else:
+                    df_all['carried_over'] = False
                 
-                # Foglio Bing
-                bing_results = df_all[df_all['source'].str.contains('Bing', na=False)]
-                if not bing_results.empty:
-                    bing_results = bing_results[['keyword', 'position', 'title', 'url', 'snippet', 'date', 'timestamp']]
-                    bing_results.to_excel(writer, sheet_name='Bing', index=False)
-                    logging.info(f"  ✓ Foglio Bing: {len(bing_results)} risultati")
+                if df_all['locale'].nunique() > 1:
+                    # Matrice di locale: un foglio per locale + confronto posizioni
+                    used_sheets = set()
+                    for locale_name, df_locale in df_all.groupby('locale', sort=False):
+                        sheet_name = excel_sheet_name(f"Locale {locale_name}", used_sheets)
+                        df_locale[['engine'] + result_columns].to_excel(writer, sheet_name=sheet_name, index=False)
+                        logging.info(f"  ✓ Foglio {sheet_name}: {len(df_locale)} risultati")
+                    
+                    df_compare = compare_locales(df_all)
+                    df_compare.to_excel(writer, sheet_name='Confronto Locale', index=False)
+                    logging.info(f"  ✓ Foglio Confronto Locale: {len(df_compare)} URL")
+                else:
+                    # Foglio Google (solo risultati organici)
+                    google_results = df_all[df_all['source'].str.contains('Google', na=False)]
+                    if not google_results.empty:
+                        google_results = google_results[result_columns]
+                        google_results.to_excel(writer, sheet_name='Google', index=False)
+                        logging.info(f"  ✓ Foglio Google: {len(google_results)} risultati")
+                    
+                    # Foglio Bing
+                    bing_results = df_all[df_all['source'].str.contains('Bing', na=False)]
+                    if not bing_results.empty:
+                        bing_results = bing_results[result_columns]
+                        bing_results.to_excel(writer, sheet_name='Bing', index=False)
+                        logging.info(f"  ✓ Foglio Bing: {len(bing_results)} risultati")
+            
+            # Foglio confronto Google/Bing (overlap e correlazione di rango)
+            if overlap is not None and not overlap.empty:
+                df_overlap = overlap.rename(columns={
+                    'keyword': 'Keyword',
+                    'locale': 'Locale',
+                    'google_results': 'URL Google',
+                    'bing_results': 'URL Bing',
+                    'shared_urls': 'URL condivisi',
+                    'jaccard': 'Jaccard',
+                    'spearman': 'Spearman',
+                    'kendall': 'Kendall',
+                    'google_only_top10': 'Solo Google (top 10)',
+                    'bing_only_top10': 'Solo Bing (top 10)'
+                })
+                for col in ['Solo Google (top 10)', 'Solo Bing (top 10)']:
+                    df_overlap[col] = df_overlap[col].str.join('\n')
+                df_overlap.to_excel(writer, sheet_name='Confronto Motori', index=False)
+                logging.info(f"  ✓ Foglio Confronto Motori: {len(df_overlap)} keywords")
             
             # 🔧 FIX: Foglio Google News (CORRETTO)
             # Le news hanno una struttura diversa, non vanno filtrate da 'results'
@@ -459,10 +1355,19 @@ def save_results(results, summary, images=None, news=None):
             if summary:
                 summary_df = pd.DataFrame([{
                     'Keyword': s['Keyword'],
+                    'Locale': s['Locale'],
                     'Risultati Google': s['Risultati Google'],
                     'Risultati Bing': s['Risultati Bing'],
+                    'Overlap (Jaccard)': s.get('Jaccard'),
+                    'Spearman': s.get('Spearman'),
+                    'Kendall': s.get('Kendall'),
+                    'Errori': s.get('Errori'),
                     'Timestamp': s['Timestamp']
                 } for s in summary])
+                if summary_df['Locale'].nunique() <= 1:
+                    summary_df = summary_df.drop(columns=['Locale'])
+                if summary_df['Errori'].isna().all():
+                    summary_df = summary_df.drop(columns=['Errori'])
                 summary_df.to_excel(writer, sheet_name='Riepilogo', index=False)
                 logging.info(f"  ✓ Foglio Riepilogo: {len(summary_df)} keywords")
             
@@ -479,7 +1384,7 @@ def save_results(results, summary, images=None, news=None):
         import traceback
         logging.error(traceback.format_exc())
 
-def send_email(summary_data, recipients, image_summary=None, news_summary=None):
+def send_email(summary_data, recipients, image_summary=None, news_summary=None, credits=None):
     """Invia email con report via Mailgun"""
     
     api_key = os.getenv('MAILGUN_API_KEY')
@@ -524,11 +1429,14 @@ def send_email(summary_data, recipients, image_summary=None, news_summary=None):
                 <h2>Riepilogo Analisi</h2>
         """
         
+        show_locale = len({item.get('Locale') for item in summary_data}) > 1
+        
         # Aggiungi risultati per keyword
         for item in summary_data:
+            locale_label = f" · {item['Locale']}" if show_locale else ''
             html += f"""
                 <div class="keyword">
-                    <h3>🔑 {item['Keyword']}</h3>
+                    <h3>🔑 {item['Keyword']}{locale_label}</h3>
                     <div class="stats">
                         <div class="stat">
                             <strong>Google:</strong> {item['Risultati Google']} risultati
@@ -536,8 +1444,18 @@ def send_email(summary_data, recipients, image_summary=None, news_summary=None):
                         <div class="stat">
                             <strong>Bing:</strong> {item['Risultati Bing']} risultati
                         </div>
-                    </div>
             """
+            if item.get('Jaccard') is not None:
+                spearman = f" · Spearman {item['Spearman']:.2f}" if item.get('Spearman') is not None else ''
+                html += f"""
+                        <div class="stat">
+                            <strong>Overlap:</strong> {item['Jaccard']:.0%}{spearman}
+                        </div>
+                """
+            html += "</div>"
+            
+            if item.get('Errori'):
+                html += f"<p style='color: #c62828;'>⚠️ Ricerca non riuscita ({item['Errori']}): i conteggi sono incompleti</p>"
             
             # Top 3 risultati Google
             if item.get('google_results') and len(item['google_results']) > 0:
@@ -584,6 +1502,9 @@ def send_email(summary_data, recipients, image_summary=None, news_summary=None):
                     html += f"<div class='keyword'><h3>🔑 {img_item['keyword']}</h3>"
                     html += f"<p>Trovate {len(img_item['images'])} immagini</p></div>"
         
+        if credits and credits['adaptive']:
+            html += f"<hr><p>💳 Crediti SerpAPI (ricerche organiche): {credits['used']} usati, {credits['saved']} risparmiati con la paginazione adattiva</p>"
+        
         html += "<hr><p><strong>📎 Report completo con TUTTI i risultati nel file Excel allegato.</strong></p>"
         html += "</body></html>"
         
@@ -623,46 +1544,106 @@ def send_email(summary_data, recipients, image_summary=None, news_summary=None):
         import traceback
         logging.error(traceback.format_exc())
 
-def run_analysis(keywords, emails, time_filter=None, num_results=30, sites=None, include_images=False, include_news=False):
+def search_errors(page_stats, keyword, locale_name):
+    """Errori delle ricerche organiche di una keyword/locale (None se tutto ok)"""
+    errors = [f"{engine.capitalize()}: {page_stats[(keyword, locale_name, engine)]['error']}"
+              for engine in ('google', 'bing') if page_stats[(keyword, locale_name, engine)].get('error')]
+    return '; '.join(errors) or None
+
+def run_analysis(keywords, emails, time_filter=None, num_results=30, sites=None, include_images=False, include_news=False, locales=None, adaptive=False, distributed=False):
     """
+    Esegue keyword × locale × motore come un unico job concorrente.
+    Tutte le ricerche condividono il budget di richieste di serpapi_limiter;
+    immagini e news vengono cercate sulla prima locale della matrice.
+    Con adaptive=True la profondità di paginazione di ogni ricerca organica
+    dipende dallo storico (vedi adaptive_search).
+    Con distributed=True le ricerche organiche vengono divise in shard ed eseguite
+    dai worker della coda condivisa (vedi distribute_job).
+    
     🔧 FIX: Corretto il passaggio delle news alla funzione save_results
     """
     global analysis_status
+    locales = locales or [default_locale()]
+    main_locale = locales[0]
     all_results = []
     all_images = []
     all_news = []  # ⭐ Lista separata per le news
     summary_data = []
     image_summary = []
     news_summary = []
-    total = len(keywords)
-    
-    for idx, keyword in enumerate(keywords, 1):
-        analysis_status['current_keyword'] = keyword
-        analysis_status['progress'] = int((idx / total) * 100)
-        
-        # Ricerca organica Google e Bing
-        google_results = search_google(keyword, num_results=num_results, time_filter=time_filter, sites=sites)
-        bing_results = search_bing(keyword, num_results=num_results, time_filter=time_filter, sites=sites)
-        combined = google_results + bing_results
-        
-        for r in combined:
-            r['keyword'] = keyword
-            r['timestamp'] = datetime.now().isoformat()
-        
-        all_results.extend(combined)
-        summary_data.append({
-            'Keyword': keyword, 
-            'Risultati Google': len(google_results),
-            'Risultati Bing': len(bing_results), 
-            'Timestamp': datetime.now().isoformat(),
-            'google_results': google_results, 
-            'bing_results': bing_results
-        })
-        analysis_status['results'].append(summary_data[-1])
-        
-        # Cerca immagini se richiesto
+    
+    history = load_history()
+    page_stats = {}
+    
+    # Un task per ogni combinazione keyword × locale × motore
+    tasks = {}
+    for keyword in keywords:
+        for locale in locales:
+            for engine in ('google', 'bing'):
+                key = (keyword, locale['name'], engine)
+                page_stats[key] = {}
+                if not distributed:
+                    tasks[key] = organic_search_task(keyword, engine, locale, num_results, time_filter, sites,
+                                                     history if adaptive else None, page_stats[key])
         if include_images:
-            image_results = search_google_images(keyword, num_results=num_results, sites=sites)
+            tasks[(keyword, main_locale['name'], 'images')] = (search_google_images, {'num_results': num_results, 'sites': sites, 'locale': main_locale})
+        if include_news:
+            tasks[(keyword, main_locale['name'], 'news')] = (search_google_news, {'num_results': num_results, 'time_filter': time_filter, 'sites': sites, 'locale': main_locale})
+    
+    searches = len(tasks) + (len(page_stats) if distributed else 0)
+    logging.info(f"🚀 Job: {len(keywords)} keyword × {len(locales)} locale ({searches} ricerche, {MAX_WORKERS} worker)")
+    
+    found = {}
+    total = len(tasks)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(search_fn, key[0], **kwargs): key for key, (search_fn, kwargs) in tasks.items()}
+        if distributed:
+            # Immagini e news restano locali, le ricerche organiche vanno ai worker
+            found.update(distribute_job(keywords, locales, page_stats, num_results, time_filter, sites,
+                                        history if adaptive else None))
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            found[key] = future.result()
+            analysis_status['current_keyword'] = key[0] if len(locales) == 1 else f"{key[0]} ({key[1]})"
+            analysis_status['progress'] = int((done / total) * 100)
+            bump_version()
+    
+    # Ricompone i risultati nell'ordine delle keyword e delle locale
+    for keyword in keywords:
+        for locale in locales:
+            google_results = found[(keyword, locale['name'], 'google')]
+            bing_results = found[(keyword, locale['name'], 'bing')]
+            combined = google_results + bing_results
+            
+            for r in combined:
+                r['keyword'] = keyword
+                r['timestamp'] = datetime.now().isoformat()
+            
+            all_results.extend(combined)
+            summary_data.append({
+                'Keyword': keyword, 
+                'Locale': locale['name'],
+                'Risultati Google': len(google_results),
+                'Risultati Bing': len(bing_results), 
+                'Errori': search_errors(page_stats, keyword, locale['name']),
+                'Timestamp': datetime.now().isoformat(),
+                'google_results': google_results, 
+                'bing_results': bing_results
+            })
+            analysis_status['results'].append(summary_data[-1])
+            bump_version()
+            
+            for engine, engine_results in (('google', google_results), ('bing', bing_results)):
+                engine_stats = page_stats[(keyword, locale['name'], engine)]
+                # Una ricerca fallita non dice nulla sulla profondità reale della SERP
+                if engine_stats.get('error'):
+                    continue
+                update_history(history, history_key(engine, keyword, locale, time_filter, sites), engine_results,
+                               num_results, full=engine_stats.get('full', True))
+        
+        # Immagini se richieste
+        if include_images:
+            image_results = found[(keyword, main_locale['name'], 'images')]
             for img in image_results:
                 img['keyword'] = keyword
                 img['timestamp'] = datetime.now().isoformat()
@@ -672,10 +1653,9 @@ def run_analysis(keywords, emails, time_filter=None, num_results=30, sites=None,
                 'images': image_results
             })
         
-        # 🔧 FIX: Cerca news se richiesto
+        # 🔧 FIX: News se richieste
         if include_news:
-            logging.info(f"📰 Cercando news per: {keyword}")
-            news_results = search_google_news(keyword, num_results=num_results, time_filter=time_filter, sites=sites)
+            news_results = found[(keyword, main_locale['name'], 'news')]
             
             # Aggiungi keyword e timestamp a ogni news
             for news in news_results:
@@ -689,16 +1669,40 @@ def run_analysis(keywords, emails, time_filter=None, num_results=30, sites=None,
             })
             logging.info(f"  ✓ Trovate {len(news_results)} news per '{keyword}'")
     
+    save_history(history)
+    
+    # Crediti SerpAPI delle ricerche organiche (1 pagina = 1 credito)
+    pages_used = sum(st.get('pages', 0) for st in page_stats.values())
+    pages_baseline = sum(st.get('baseline', st.get('pages', 0)) for st in page_stats.values()) if adaptive else pages_used
+    credits = {'adaptive': adaptive, 'used': pages_used, 'saved': max(0, pages_baseline - pages_used)}
+    analysis_status['credits'] = credits
+    logging.info(f"💳 Crediti ricerche organiche: {credits['used']} usati, {credits['saved']} risparmiati")
+    
+    # Confronto Google/Bing calcolato in un unico passaggio su tutte le keyword
+    overlap = compute_engine_overlap(all_results)
+    records = overlap_records(overlap)
+    overlap_by_key = {(r['keyword'], r['locale']): r for r in records}
+    for item in summary_data:
+        row = overlap_by_key.get((item['Keyword'], item['Locale']), {})
+        item['Jaccard'] = row.get('jaccard')
+        item['Spearman'] = row.get('spearman')
+        item['Kendall'] = row.get('kendall')
+    overlap_results[:] = records
+    result_rows['organic'] = all_results
+    result_rows['news'] = all_news
+    bump_version()
+    
     # 🔧 FIX: Passa all_news come parametro separato (NON dentro all_results)
     save_results(
         all_results,  # Solo risultati organici Google/Bing
         summary_data, 
         all_images if include_images else None, 
-        all_news if include_news else None  # ⭐ Passa le news separatamente
+        all_news if include_news else None,  # ⭐ Passa le news separatamente
+        overlap
     )
     
     if emails:
-        send_email(summary_data, emails, image_summary if include_images else None, news_summary if include_news else None)
+        send_email(summary_data, emails, image_summary if include_images else None, news_summary if include_news else None, credits)
     
     analysis_status['running'] = False
     analysis_status['progress'] = 100
@@ -706,6 +1710,7 @@ def run_analysis(keywords, emails, time_filter=None, num_results=30, sites=None,
     # Aggiungi news allo status per mostrarle nell'interfaccia
     if include_news and len(news_summary) > 0:
         analysis_status['news_results'] = news_summary
+    bump_version()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -741,12 +1746,23 @@ def analyze():
     sites = data.get('sites', [])
     include_images = data.get('include_images', False)
     include_news = data.get('include_news', False)
+    adaptive = data.get('adaptive', False)
+    distributed = data.get('distributed', False)
     
     if not keywords:
         return jsonify({'error': 'Nessuna keyword'}), 400
     
+    # Matrice di locale opzionale: lista di dict o di tuple domain/gl/hl/market/cc
+    try:
+        locales = parse_locales(data.get('locales') or [])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     analysis_status = {'running': True, 'progress': 0, 'current_keyword': '', 'results': []}
-    thread = threading.Thread(target=run_analysis, args=(keywords, emails, time_filter, num_results, sites, include_images, include_news))
+    result_rows['organic'] = []
+    result_rows['news'] = []
+    bump_version()
+    thread = threading.Thread(target=run_analysis, args=(keywords, emails, time_filter, num_results, sites, include_images, include_news, locales, adaptive, distributed))
     thread.daemon = True
     thread.start()
     return jsonify({'status': 'started'})
@@ -754,7 +1770,82 @@ def analyze():
 @app.route('/status')
 @login_required
 def status():
-    return jsonify(analysis_status)
+    """
+    Stato dell'analisi senza le liste di risultati (si leggono da /results):
+    per ogni keyword solo i conteggi, per le news solo il numero per keyword.
+    """
+    def build():
+        light = dict(analysis_status)
+        light['results'] = [{k: v for k, v in item.items() if k not in ('google_results', 'bing_results')}
+                            for item in analysis_status['results']]
+        if 'news_results' in analysis_status:
+            light['news_results'] = [{'keyword': item['keyword'], 'count': len(item['news'])}
+                                     for item in analysis_status['news_results']]
+        return light
+    
+    return json_response(build)
+
+@app.route('/results')
+@login_required
+def results():
+    """
+    Righe dell'ultima analisi con paginazione a cursore.
+    
+    Parametri: type (organic|news), keyword, locale, engine (google|bing),
+    fields (lista separata da virgole), limit, cursor (next_cursor della pagina precedente).
+    """
+    result_type = request.args.get('type', 'organic')
+    if result_type not in RESULT_FIELDS:
+        return jsonify({'error': f"Tipo non valido: {result_type}"}), 400
+    
+    available = RESULT_FIELDS[result_type]
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(available)
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        return jsonify({'error': f"Campi non validi: {', '.join(unknown)}"}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', RESULTS_PAGE_SIZE)), 1), RESULTS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': f"Limit non valido: deve essere un numero intero tra 1 e {RESULTS_MAX_PAGE_SIZE}"}), 400
+    try:
+        offset = decode_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    keyword = request.args.get('keyword')
+    locale = request.args.get('locale')
+    engine = request.args.get('engine')
+    
+    def build():
+        rows = [r for r in result_rows[result_type]
+                if (not keyword or r.get('keyword') == keyword)
+                and (not locale or r.get('locale') == locale.upper())
+                and (not engine or r.get('engine') == engine.lower())]
+        page = [{f: r.get(f) for f in fields} for r in rows[offset:offset + limit]]
+        next_offset = offset + limit
+        return {
+            'total': len(rows),
+            'count': len(page),
+            'results': page,
+            'next_cursor': encode_cursor(next_offset) if next_offset < len(rows) else None
+        }
+    
+    return json_response(build)
+
+@app.route('/analytics/overlap')
+@login_required
+def analytics_overlap():
+    """Confronto Google/Bing dell'ultima analisi, filtrabile per keyword e locale"""
+    keyword = request.args.get('keyword')
+    locale = request.args.get('locale')
+    
+    def build():
+        rows = [r for r in overlap_results
+                if (not keyword or r['keyword'] == keyword) and (not locale or r['locale'] == locale.upper())]
+        return {'count': len(rows), 'results': rows}
+    
+    return json_response(build)
 
 @app.route('/download')
 @login_required
@@ -765,5 +1856,13 @@ def download():
     return jsonify({'error': 'File non trovato'}), 404
 
 if __name__ == '__main__':
+    # `python app.py worker`: esegue solo il worker della coda distribuita
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        if not os.getenv('SERPAPI_KEY'):
+            logging.error("SERPAPI_KEY non configurata!")
+            sys.exit(1)
+        run_worker()
+        sys.exit(0)
+    
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file